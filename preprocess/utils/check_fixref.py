@@ -0,0 +1,146 @@
+# Round-trip check of `xcltk fixref` over its I/O paths
+# Author: Xianjie Huang
+
+# A small fasta and vcf are generated in a temp dir, then fixref is run with
+# plain, gzipped & bgzipped (tabix-indexed) vcf input, .vcf.gz & .bcf output
+# and -p > 1. Every path is required to give the same records as the plain
+# vcf path, byte-identical where the output is text vcf.
+# Usage: python check_fixref.py   (exit 0 if all checks pass)
+
+import os
+import sys
+import gzip
+import random
+import shutil
+import tempfile
+import pysam
+
+from xcltk.baf.fixref import fixref
+
+CHROMS = [("chr1", 3000), ("chr2", 2000), ("chrX", 1000)]
+GTS = ["0/1", "1/0", "0|1", "1|1", "0/0", "1/1", "./."]
+
+def __gen_fasta(fn, seed = 1):
+    random.seed(seed)
+    seqs = {}
+    with open(fn, "w") as fp:
+        for chrom, n in CHROMS:
+            seqs[chrom] = "".join([random.choice("ACGT") for _ in range(n)])
+            fp.write(">%s\n" % chrom)
+            for i in range(0, n, 60):
+                fp.write(seqs[chrom][i:i + 60] + "\n")
+    pysam.faidx(fn)
+    return(seqs)
+
+def __gen_vcf(fn, seqs, nrec = 200, seed = 1):
+    random.seed(seed)
+    fp = open(fn, "w")
+    fp.write("##fileformat=VCFv4.2\n")
+    for chrom, n in CHROMS:
+        fp.write("##contig=<ID=%s,length=%d>\n" % (chrom, n))
+    fp.write('##FILTER=<ID=PASS,Description="All filters passed">\n')
+    fp.write('##INFO=<ID=DP,Number=1,Type=Integer,Description="Depth">\n')
+    fp.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+    fp.write('##FORMAT=<ID=AD,Number=R,Type=Integer,Description="Allele depth">\n')
+    fp.write("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\tS1\n")
+    for chrom, n in CHROMS:
+        for pos in sorted(random.sample(range(1, n + 1), nrec)):
+            ref0 = seqs[chrom][pos - 1]
+            ref = ref0 if random.random() < 0.5 else random.choice("ACGT")
+            alts = random.sample([b for b in "ACGT" if b != ref], random.choice([1, 1, 2]))
+            gt = random.choice(GTS + (["1/2", "2|1"] if len(alts) > 1 else []))
+            ad = ",".join(["3"] * (len(alts) + 1))
+            # GT comes first in FORMAT, as htslib (the bcf path) requires
+            fp.write("\t".join([chrom, str(pos), "rs%d" % pos, ref, ",".join(alts),
+                "50", "PASS", "DP=7", "GT:AD", "%s:%s" % (gt, ad)]) + "\n")
+    fp.close()
+
+def __run(in_fn, out_fn, ref_fn, *opts):
+    fixref(["xcltk", "fixref", "-i", in_fn, "-o", out_fn, "-r", ref_fn] + list(opts))
+
+def __read_text(fn):
+    fp = gzip.open(fn, "rt") if fn.endswith(".gz") else open(fn, "r")
+    dat = fp.read()
+    fp.close()
+    return(dat)
+
+def __load_recs(fn):
+    """Load (chrom, pos, ref, alts, GT) of each record through pysam."""
+    recs = []
+    vcf = pysam.VariantFile(fn)
+    for rec in vcf:
+        alts = tuple([a for a in (rec.alts or ()) if a != "."])
+        smp = rec.samples[0]
+        gt = "/".join([str(i) for i in smp["GT"]])
+        recs.append((rec.chrom, rec.pos, rec.ref, alts, gt))
+    vcf.close()
+    return(recs)
+
+def main():
+    tmp_dir = tempfile.mkdtemp(prefix = "xcltk_check_fixref_")
+    fn = lambda x: os.path.join(tmp_dir, x)
+    ret = 0
+    def __check(name, ok):
+        sys.stdout.write("[%s] %s\n" % ("OK" if ok else "FAIL", name))
+        return(0 if ok else 1)
+
+    try:
+        seqs = __gen_fasta(fn("ref.fa"))
+        __gen_vcf(fn("in.vcf"), seqs)
+        with open(fn("in.vcf"), "rb") as fi, gzip.open(fn("in.gzip.vcf.gz"), "wb") as fo:
+            shutil.copyfileobj(fi, fo)
+        pysam.tabix_compress(fn("in.vcf"), fn("in.vcf.gz"))
+        pysam.tabix_index(fn("in.vcf.gz"), preset = "vcf")
+        with open(fn("in.vcf"), "r") as fp:
+            lines = fp.readlines()
+        hdr = [l for l in lines if l[0] == "#"]
+        recs = [l for l in lines if l[0] != "#"]
+        random.seed(2)
+        random.shuffle(recs)
+        with open(fn("in.unsorted.vcf"), "w") as fp:
+            fp.write("".join(hdr + recs))
+
+        # plain vcf, serial, as the expected output
+        __run(fn("in.vcf"), fn("out.vcf"), fn("ref.fa"))
+        expected = __read_text(fn("out.vcf"))
+        ret |= __check("plain vcf has fixed records", "\t.\tGT\t" in expected)
+
+        for name, in_fn, out_fn, opts in [
+            ("bgzipped vcf input", "in.vcf.gz", "out.bgz.vcf", []),
+            ("gzipped vcf input", "in.gzip.vcf.gz", "out.gzip.vcf", []),
+            (".vcf.gz output", "in.vcf", "out.vcf.gz", []),
+            ("plain vcf input, -p 2", "in.vcf", "out.p2.vcf", ["-p", "2"]),
+            ("indexed bgzipped vcf input, -p 2", "in.vcf.gz", "out.tbx.p2.vcf", ["-p", "2"])
+        ]:
+            __run(fn(in_fn), fn(out_fn), fn("ref.fa"), *opts)
+            ret |= __check(name, __read_text(fn(out_fn)) == expected)
+
+        # unsorted input is reordered, hence only the record sets are compared
+        __run(fn("in.unsorted.vcf"), fn("out.unsorted.vcf"), fn("ref.fa"))
+        __run(fn("in.unsorted.vcf"), fn("out.unsorted.p2.vcf"), fn("ref.fa"), "-p", "2")
+        exp_set = sorted(expected.splitlines())
+        ret |= __check("unsorted plain vcf input",
+            sorted(__read_text(fn("out.unsorted.vcf")).splitlines()) == exp_set)
+        ret |= __check("unsorted plain vcf input, -p 2",
+            sorted(__read_text(fn("out.unsorted.p2.vcf")).splitlines()) == exp_set)
+
+        # bcf goes through pysam.VariantFile, records are compared
+        exp_recs = __load_recs(fn("out.vcf"))
+        __run(fn("in.vcf"), fn("out.bcf"), fn("ref.fa"))
+        ret |= __check("bcf output", __load_recs(fn("out.bcf")) == exp_recs)
+        vcf = pysam.VariantFile(fn("in.vcf"))
+        bcf = pysam.VariantFile(fn("in.bcf"), "wb", header = vcf.header)
+        for rec in vcf:
+            bcf.write(rec)
+        bcf.close()
+        vcf.close()
+        __run(fn("in.bcf"), fn("out.bcf2.bcf"), fn("ref.fa"))
+        ret |= __check("bcf input and output", __load_recs(fn("out.bcf2.bcf")) == exp_recs)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors = True)
+
+    sys.stdout.write("%s\n" % ("All checks passed!" if ret == 0 else "Some checks failed!"))
+    return(ret)
+
+if __name__ == "__main__":
+    sys.exit(main())
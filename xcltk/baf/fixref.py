@@ -3,86 +3,174 @@
 #it would change corresponding ALT & GT while delete other fields in FORMAT
 #Author: Xianjie Huang 
 
+import os
 import sys
 import getopt
 import time
 import gzip
+import shutil
+import tempfile
+import itertools
+import multiprocessing
 import pysam
+from collections import OrderedDict
 from .config import APP
 
 COMMAND = "fixref"
 
-def __load_ref(fn):
+REF_WIN_SHIFT = 17     # ref fasta is cached in windows of 2^17 = 128KB
+REF_WIN_MAX = 200      # max number of cached windows, i.e., ~25MB
+
+VALID_ALLELES = frozenset("ACGTN")
+
+OUT_BUF_SIZE = 65536   # output is written in batches of ~64KB
+SPLIT_BUF_SIZE = 1 << 24   # records are split by chrom in batches of ~16MB
+LOG_BUF_SIZE = 10000   # verbose messages are written in batches of 10000 records
+
+# GT str => (sep, idx1, idx2), for the common biallelic GTs
+GT_TABLE = {
+    "0/0": ("/", 0, 0), "0/1": ("/", 0, 1), "1/0": ("/", 1, 0), "1/1": ("/", 1, 1),
+    "0|0": ("|", 0, 0), "0|1": ("|", 0, 1), "1|0": ("|", 1, 0), "1|1": ("|", 1, 1)
+}
+
+GT_IDX_CACHE = {}      # FORMAT str => index of GT in it, -1 if GT is absent
+
+def __get_gt_idx(fmt):
     """
-    @abstract    Load ref fasta file and extract ref alleles
-    @param fn    Path to ref fasta file [str]
-    @return      List of ref alleles [list<str>]
-    @note        The extracted ref allele will be "" if the corresponding 
-                 fasta record is empty.
+    @abstract    Get index of GT in the FORMAT str, cached per FORMAT str
+    @param fmt   The FORMAT str, e.g., "GT:AD:DP" [str]
+    @return      0-based index of GT, -1 if GT is absent [int]
     """
-    def __fmt_ref(i, r, n):
-        if r != ">": return(r)
-        elif i + 1 >= n or ref_alleles[i + 1] == ">": return("")
-        else: return(None)
-    fp = gzip.open(fn, "rt") if fn.endswith(".gz") else open(fn, "r")
-    ref_alleles = [line[0] for line in fp]
-    fp.close()
-    n = len(ref_alleles)
-    ref_alleles = [__fmt_ref(i, r, n) for i, r in enumerate(ref_alleles)]
-    ref_alleles = [r for r in ref_alleles if r is not None]
-    return(ref_alleles)
+    gt_idx = GT_IDX_CACHE.get(fmt)
+    if gt_idx is None:
+        gt_idx = -1
+        i = start = 0
+        while start <= len(fmt):
+            end = fmt.find(":", start)
+            if end < 0: end = len(fmt)
+            if fmt[start:end] == "GT":
+                gt_idx = i
+                break
+            i += 1
+            start = end + 1
+        GT_IDX_CACHE[fmt] = gt_idx
+    return gt_idx
+
+def __get_ref_win(fasta, ref_wins, chrom, win_idx):
+    """
+    @abstract         Get one window of ref sequence, cached in a LRU
+    @param fasta      The ref fasta [pysam.FastaFile]
+    @param ref_wins   LRU cache of ref windows, (chrom, win_idx) => seq [OrderedDict]
+    @param chrom      Chrom name, must be one of fasta.references [str]
+    @param win_idx    Index of the window, i.e., 0-based pos >> REF_WIN_SHIFT [int]
+    @return           Sequence of the window, could be shorter than the window
+                      size at the end of chrom [str]
+    """
+    key = (chrom, win_idx)
+    seq = ref_wins.get(key)
+    if seq is None:
+        win_start = win_idx << REF_WIN_SHIFT
+        seq = fasta.fetch(reference = chrom, start = win_start, end = win_start + (1 << REF_WIN_SHIFT))
+        ref_wins[key] = seq
+        if len(ref_wins) > REF_WIN_MAX:
+            ref_wins.popitem(last = False)
+    else:
+        ref_wins.move_to_end(key)
+    return seq
 
-def __fix_rec(nr, ref0, line):
+def __fix_alleles(ref0, allele1, allele2):
+    """
+    @abstract         Re-encode the two GT alleles against the real REF
+    @param ref0       Real REF from fasta [chr]
+    @param allele1    The first allele of GT [chr]
+    @param allele2    The second allele of GT [chr]
+    @return           A tuple of three elements: new ALTs, new index of allele1 and
+                      new index of allele2 [tuple<list<str>, int, int>]
+    """
+    new_alts = []
+    new_idx1 = new_idx2 = None
+    if allele1 == ref0: new_idx1 = 0
+    else: new_idx1 = 1; new_alts.append(allele1)
+    if allele2 == ref0: new_idx2 = 0
+    elif allele2 == allele1: new_idx2 = new_idx1
+    else: new_idx2 = new_idx1 + 1; new_alts.append(allele2)
+    return((new_alts, new_idx1, new_idx2))
+
+def __fix_rec(nr, ref0, line, chrom, pos, t2, msgs = None):
     """
     @abstract      Check & fix ref and corresponding alt & GT for one vcf record
     @param nr      Index of the vcf record, 1-based [int]
     @param ref0    Real REF from fasta [chr]
     @param line    The vcf record whose ref is to be checked, ends with '\n' [str]
+    @param chrom   CHROM of the record, already parsed by caller [str]
+    @param pos     POS of the record, already parsed by caller [str]
+    @param t2      Offset of the tab after POS in `line` [int]
+    @param msgs    List to collect the info message of the fix, not
+                   collected if None [list<str>]
     @return        A tuple of two elements: the running state and the checked line [tuple<int, str>]
                    The running state: 
                      -1, if error;
                      0, if ref == ref0, i.e., no fix is needed
                      1, if vcf record is successfully fixref-ed.
     """
-    parts = line[:-1].split("\t")
-    try:
-        chrom, pos, ref, alt, fmt, fval = parts[0], parts[1], parts[3], parts[4], parts[8], parts[9] 
-    except:
+    # No fix is needed. Only REF is extracted here, as most records are
+    # expected to match the ref fasta already.
+    t3 = line.find("\t", t2 + 1)
+    t4 = line.find("\t", t3 + 1) if t3 >= 0 else -1
+    if t4 >= 0 and line[t3 + 1:t4] == ref0:
+        return (0, line)
+
+    # locate the tabs ending ALT, QUAL, FILTER, INFO and FORMAT, so that
+    # the output line could be spliced without splitting the whole line.
+    t5 = t6 = t7 = t8 = t9 = -1
+    if t4 >= 0: t5 = line.find("\t", t4 + 1)
+    if t5 >= 0: t6 = line.find("\t", t5 + 1)
+    if t6 >= 0: t7 = line.find("\t", t6 + 1)
+    if t7 >= 0: t8 = line.find("\t", t7 + 1)
+    if t8 >= 0: t9 = line.find("\t", t8 + 1)
+    if t9 < 0:
         sys.stderr.write("[W::fix_rec] skip No.%d line for failing to parse vcf line.\n" % nr)
         return((-1, None))
-    
-    # No fix is needed
-    if ref == ref0:
-        return (0, line)
-    
-    fmt_parts = fmt.split(":")
-    fval_parts = fval.split(":")
-    try:
-        gt_idx = fmt_parts.index("GT")
-        gt = fval_parts[gt_idx]
-    except:
+    t10 = line.find("\t", t9 + 1)     # -1 if only one sample
+    ref, alt, fmt = line[t3 + 1:t4], line[t4 + 1:t5], line[t8 + 1:t9]
+    fval = line[t9 + 1:t10] if t10 >= 0 else line[t9 + 1:-1]
+
+    gt = None
+    gt_idx = __get_gt_idx(fmt)
+    if gt_idx == 0:
+        j = fval.find(":")
+        gt = fval if j < 0 else fval[:j]
+    elif gt_idx > 0:
+        fval_parts = fval.split(":")
+        if gt_idx < len(fval_parts):
+            gt = fval_parts[gt_idx]
+    if gt is None:
         sys.stderr.write("[W::fix_rec] skip No.%d %s:%s for error GT, format str: %s; format value: %s\n" % (nr, chrom, pos, fmt, fval))
         return((-1, None))
     new_alt = alt
     new_gt = gt
     if ref != ref0:
-        sep = None
-        if "/" in gt: 
-            sep = "/"
-        elif "|" in gt: 
-            sep = "|"
+        gt_info = GT_TABLE.get(gt)
+        if gt_info is not None:
+            sep, idx1, idx2 = gt_info
         else:
-            sys.stderr.write("[W::fix_rec] skip No.%d %s:%s for error GT sep, GT str: %s\n" % (nr, chrom, pos, gt))
-            return((-1, None))
-        ra_idx = gt.split(sep)    # index of ref/alt: 0, 1, 2
-        if len(ra_idx) != 2: 
-            sys.stderr.write("[W::fix_rec] skip No.%d %s:%s for error GT alleles, GT str: %s\n" % (nr, chrom, pos, gt))
-            return((-1, None))
-        try:
-            idx1, idx2 = int(ra_idx[0]), int(ra_idx[1])
-        except:
-            sys.stderr.write("[W::fix_rec] skip No.%d %s:%s for error GT allele index, GT str: %s\n" % (nr, chrom, pos, gt))
-            return((-1, None))
+            sep = None
+            if "/" in gt: 
+                sep = "/"
+            elif "|" in gt: 
+                sep = "|"
+            else:
+                sys.stderr.write("[W::fix_rec] skip No.%d %s:%s for error GT sep, GT str: %s\n" % (nr, chrom, pos, gt))
+                return((-1, None))
+            ra_idx = gt.split(sep)    # index of ref/alt: 0, 1, 2
+            if len(ra_idx) != 2: 
+                sys.stderr.write("[W::fix_rec] skip No.%d %s:%s for error GT alleles, GT str: %s\n" % (nr, chrom, pos, gt))
+                return((-1, None))
+            try:
+                idx1, idx2 = int(ra_idx[0]), int(ra_idx[1])
+            except:
+                sys.stderr.write("[W::fix_rec] skip No.%d %s:%s for error GT allele index, GT str: %s\n" % (nr, chrom, pos, gt))
+                return((-1, None))
         allele1 = allele2 = None
         multi_alt = alt.split(",")
         try:
@@ -93,97 +181,457 @@ def __fix_rec(nr, ref0, line):
         except:
             sys.stderr.write("[W::fix_rec] skip No.%d %s:%s for error ALT, ALT str: %s\n" % (nr, chrom, pos, alt))
             return((-1, None))
-        if len(allele1) != 1 or len(allele2) != 1 or allele1 not in "ACGTN" or allele2 not in "ACGTN":
+        if allele1 not in VALID_ALLELES or allele2 not in VALID_ALLELES:
             sys.stderr.write("[W::fix_rec] skip No.%d %s:%s for invalid allele, allele1 = %s; allele2 = %s\n" % (nr, chrom, pos, allele1, allele2))
             return((-1, None))
-        new_alts = []
-        new_idx1 = new_idx2 = None
-        if allele1 == ref0: new_idx1 = 0
-        else: new_idx1 = 1; new_alts.append(allele1)
-        if allele2 == ref0: new_idx2 = 0
-        elif allele2 == allele1: new_idx2 = new_idx1
-        else: new_idx2 = new_idx1 + 1; new_alts.append(allele2)
+        new_alts, new_idx1, new_idx2 = __fix_alleles(ref0, allele1, allele2)
         new_alt = ",".join(new_alts) if new_alts else "."
         new_gt = sep.join([str(i) for i in [new_idx1, new_idx2]])   # CHECK ME! does the order of allele indexes matter?
         #if new_idx1 == 0 and new_idx2 == 0:
         #    sys.stderr.write("[W::fix_rec] skip %s:%s for new gt being 0/0, from %s:%s:%s to %s:%s:%s.\n" % (chrom, pos, ref, alt, gt, ref0, new_alt, new_gt))
         #    return((-1, None))
-    parts[2] = parts[5] = parts[7] = "."
-    parts[3] = ref0
-    parts[4] = new_alt
-    parts[8] = "GT"
-    parts[9] = new_gt
-    new_vcf_line = "\t".join(parts) + "\n"
-    if ref != ref0:
-        sys.stderr.write("[I::fix_rec] change No.%d %s:%s from %s:%s:%s to %s:%s:%s\n" % (nr, chrom, pos, ref, alt, gt, ref0, new_alt, new_gt))
+    # ID, QUAL & INFO are cleared while FILTER and other samples are kept
+    new_vcf_line = line[:t2 + 1] + ".\t" + ref0 + "\t" + new_alt + "\t.\t" +  \
+                   line[t6 + 1:t7] + "\t.\tGT\t" + new_gt +                  \
+                   (line[t10:-1] if t10 >= 0 else "") + "\n"
+    if msgs is not None:
+        msgs.append("[I::fix_rec] change No.%d %s:%s from %s:%s:%s to %s:%s:%s\n" % (nr, chrom, pos, ref, alt, gt, ref0, new_alt, new_gt))
     return((1, new_vcf_line))
 
-def __fix_file(in_fn, out_fn, ref_fn):
+def __open_vcf(fn):
     """
-    @abstract       Fix REF, ALT & GT while delete other fields in FORMAT
-    @param in_fn    Input vcf file to be fixed [str]
-    @param out_fn   Output vcf file [str]
-    @param ref_fn   Ref fasta file generated by samtools faidx [str]
-    @return         0 if success, -1 otherwise
+    @abstract    Open vcf file for reading, bgzipped file is read through htslib
+    @param fn    Path to the vcf file, plain, gzipped or bgzipped [str]
+    @return      A tuple of two elements: the file object to be closed and
+                 an iterator of the lines [tuple<object, iterator<str>>]
     """
-    # load ref fasta and input vcf
-    # ref_alleles = __load_ref(ref_fn)
-    
-    FASTA = pysam.FastaFile(ref_fn)
-
-    ifp = gzip.open(in_fn, "rt") if in_fn.endswith(".gz") else open(in_fn, "r")
-    vcf_lines = ifp.readlines()
-    ifp.close()
-    nc = 0     # number of vcf comment lines.
-    for line in vcf_lines:
-        if line[0] == "#": nc += 1
-        else: break
-    # sys.stderr.write("Info: len(vcf_lines) = %d; len(ref_alleles) = %d; len(comment_lines) = %d\n" % (len(vcf_lines), len(ref_alleles), nc))
-    # if len(vcf_lines) - nc != len(ref_alleles):
-    #     sys.stderr.write("Error: nlines of ref_alleles is not equal to nrecords of vcf!\n")
-    #     return(-1)
-    
-    # fixref and output
-    # TODO: add cmdline of this run to the output file
-    ofp = None
-    if out_fn:
-        ofp = gzip.open(out_fn, "wb") if out_fn.endswith(".gz") else open(out_fn, "w")
+    if fn.endswith(".gz"):
+        try:
+            fp = pysam.BGZFile(fn, "r")
+            # lines from BGZFile come without the trailing newline
+            return((fp, (line.decode() + "\n" for line in fp)))
+        except (IOError, ValueError):
+            fp = gzip.open(fn, "rt")     # plain gzip, not bgzipped
     else:
-        ofp = sys.stdout
-    for i in range(nc):
-        ofp.write(vcf_lines[i])   
-    nr = 0
+        fp = open(fn, "r")
+    return((fp, fp))
+
+def __open_out(fn):
+    """
+    @abstract    Open output vcf file, bgzipped if fn ends with ".gz"
+    @param fn    Path to the output file, stdout if None [str]
+    @return      A tuple of two elements: the file object and a function
+                 writing str to it [tuple<object, function>]
+    """
+    if not fn:
+        return((sys.stdout, sys.stdout.write))
+    if fn.endswith(".gz"):
+        fp = pysam.BGZFile(fn, "wb")
+        def out_write(s): fp.write(s.encode())
+        return((fp, out_write))
+    fp = open(fn, "w")
+    return((fp, fp.write))
+
+def __fix_lines(lines, fasta, out_write, verbose = False, stop_if_unsorted = False, nr0 = 0):
+    """
+    @abstract          Fix REF, ALT & GT for vcf records and output
+    @param lines       Iterator of vcf records, each ends with '\n' [iterator<str>]
+    @param fasta       The ref fasta [pysam.FastaFile]
+    @param out_write   Function to write str to output [function]
+    @param verbose     If True, output info message of each fixed record [bool]
+    @param stop_if_unsorted  If True, stop before the first record whose chrom
+                       has been met before but not in the previous record [bool]
+    @param nr0         Number of records already processed before `lines` [int]
+    @return            A tuple of four elements: the running state, 0 if success,
+                       1 if stopped for unsorted records and -1 otherwise, number 
+                       of records (including nr0), number of fixed records and 
+                       number of matched records [tuple<int>]
+    """
+    ref_wins = OrderedDict()    # LRU cache of ref windows, (chrom, win_idx) => seq
+    win_mask = (1 << REF_WIN_SHIFT) - 1
+    cur_chr = cur_win = cur_seq = None     # ref window of the previous record
+    valid_chroms = set(fasta.references)
+    chr_valid = True
+    seen_chroms = set()
+    unsorted = False
+    out_bufs = []     # records to be written in one batch
+    out_size = 0
+    msgs = [] if verbose else None     # info messages to be written in one batch
+    nr = nr0
     fix_cnt = 0
     matched_cnt = 0
-    for line in vcf_lines[nc:]:
+    for line in lines:
         if line[0] in ("\n", "#"):
+            if msgs: sys.stderr.write("".join(msgs))
             sys.stderr.write("Error: invalid vcf format, wrong comment line for No.%d record!\n" % (nr + 1,))
-            return(-1)
-        
-        _chr, _pos = line.split('\t')[:2]
-        _ref_allele = FASTA.fetch(_chr, int(_pos) - 1, int(_pos))
-        ret, new_line = __fix_rec(nr + 1, _ref_allele, line)
+            out_write("".join(out_bufs))
+            return((-1, nr, fix_cnt, matched_cnt))
         
-        # if not ref_alleles[nr]:
-        #     sys.stderr.write("Warning: skip No.%d record for no real REF!\n" % (nr + 1,))
-        #     nr += 1
-        #     continue
-        # ret, new_line = __fix_rec(nr + 1, ref_alleles[nr], line)
+        t1 = line.find("\t")
+        t2 = line.find("\t", t1 + 1) if t1 >= 0 else -1
+        if t2 < 0:
+            sys.stderr.write("[W::fix_file] skip No.%d line for failing to parse vcf line.\n" % (nr + 1,))
+            nr += 1
+            continue
+        _chr, _pos = line[:t1], line[t1 + 1:t2]
+        _pos0 = int(_pos) - 1
+        _win = _pos0 >> REF_WIN_SHIFT
+        if _win != cur_win or _chr != cur_chr:
+            if _chr != cur_chr:
+                if _chr in seen_chroms and stop_if_unsorted:
+                    if msgs: sys.stderr.write("".join(msgs))
+                    out_write("".join(out_bufs))
+                    return((1, nr, fix_cnt, matched_cnt))
+                if _chr in seen_chroms and not unsorted:
+                    sys.stderr.write("[W::fix_file] records are not grouped by chrom (No.%d %s:%s), ref cache may thrash; set -p > 1 to bucket records by chrom.\n" % (nr + 1, _chr, _pos))
+                    unsorted = True
+                chr_valid = _chr in valid_chroms
+                if not chr_valid and _chr not in seen_chroms:
+                    sys.stderr.write("[W::fix_file] skip records of chrom '%s' for it is absent in ref fasta.\n" % _chr)
+                seen_chroms.add(_chr)
+            cur_chr, cur_win = _chr, _win
+            if chr_valid:
+                cur_seq = __get_ref_win(fasta, ref_wins, _chr, _win)
+        if not chr_valid:
+            nr += 1
+            continue
+        _i = _pos0 & win_mask
+        _ref_allele = cur_seq[_i:_i + 1]
+        ret, new_line = __fix_rec(nr + 1, _ref_allele, line, _chr, _pos, t2, msgs)
 
         if ret < 0: pass
-        elif ret == 0 or ret == 1: ofp.write(new_line)
+        elif ret == 0 or ret == 1:
+            out_bufs.append(new_line)
+            out_size += len(new_line)
+            if out_size >= OUT_BUF_SIZE:
+                out_write("".join(out_bufs))
+                out_bufs = []
+                out_size = 0
         else: pass
         
         nr += 1
         if ret == 1: fix_cnt += 1
         if ret == 0: matched_cnt += 1
+        if msgs and nr % LOG_BUF_SIZE == 0:
+            sys.stderr.write("".join(msgs))
+            msgs = []
         
+    if msgs: sys.stderr.write("".join(msgs))
+    out_write("".join(out_bufs))
+    return((0, nr, fix_cnt, matched_cnt))
+
+def __fix_chrom(in_fn, chrom, ref_fn, out_fn, verbose = False):
+    """
+    @abstract       Fix records of one chrom, run in subprocess
+    @param in_fn    Input vcf file, bgzipped and indexed if chrom is set; 
+                    otherwise records of one chrom without header [str]
+    @param chrom    Chrom to be fetched from in_fn by tabix, None to read
+                    the whole in_fn [str]
+    @param ref_fn   Ref fasta file generated by samtools faidx [str]
+    @param out_fn   Output file of fixed records, without header [str]
+    @param verbose  If True, output info message of each fixed record [bool]
+    @return         Same as __fix_lines() [tuple<int>]
+    """
+    fasta = pysam.FastaFile(ref_fn)
+    if chrom is None:
+        ifp = open(in_fn, "r")
+        lines = ifp
+    else:
+        ifp = pysam.TabixFile(in_fn)
+        lines = (line + "\n" for line in ifp.fetch(chrom))
+    ofp = open(out_fn, "w")
+    res = __fix_lines(lines, fasta, ofp.write, verbose)
+    ofp.close()
+    ifp.close()
+    fasta.close()
+    return(res)
+
+def __index_chrom_blocks(fn, skip = 0):
+    """
+    @abstract    Index byte offsets of the blocks of each chrom in plain vcf
+    @param fn    Path to the plain vcf file [str]
+    @param skip  Number of leading records not to be indexed [int]
+    @return      Ordered dict of chrom => list of (start, end) offsets of its 
+                 blocks, chroms are in the order of first appearance 
+                 [OrderedDict<str, list<tuple<int, int>>>]
+    """
+    blocks = OrderedDict()
+    fp = open(fn, "rb")
+    cur_chr = None
+    start = offset = 0
+    in_header = True
+    n = 0     # number of records met
+    for line in fp:
+        if in_header and line[:1] == b"#":
+            offset += len(line)
+            continue
+        in_header = False
+        n += 1
+        if n > skip:
+            chrom = line.split(b"\t", 1)[0]
+            if chrom != cur_chr:
+                if cur_chr is not None:
+                    blocks.setdefault(cur_chr.decode(), []).append((start, offset))
+                cur_chr, start = chrom, offset
+        offset += len(line)
+    if cur_chr is not None:
+        blocks.setdefault(cur_chr.decode(), []).append((start, offset))
+    fp.close()
+    return(blocks)
+
+def __iter_chrom_blocks(fp, blocks):
+    """
+    @abstract       Iterate vcf records chrom by chrom
+    @param fp       The vcf file opened in binary mode [file]
+    @param blocks   Offsets of chrom blocks returned by __index_chrom_blocks()
+    @return         Generator of vcf records [iterator<str>]
+    """
+    for chrom_blocks in blocks.values():
+        for start, end in chrom_blocks:
+            fp.seek(start)
+            while start < end:
+                line = fp.readline()
+                if not line:
+                    break
+                start += len(line)
+                if line[-1:] != b"\n":
+                    line += b"\n"     # the last line of file may have no newline
+                yield line.decode()
+
+def __split_by_chrom(lines, tmp_dir):
+    """
+    @abstract        Split vcf records into temp files by chrom
+    @param lines     Iterator of vcf records [iterator<str>]
+    @param tmp_dir   Dir of the temp files [str]
+    @return          List of tuples (chrom, temp file), in the order that each
+                     chrom first appears in the input [list<tuple<str, str>>]
+    """
+    def __flush(bufs):
+        for chrom, buf in bufs.items():
+            with open(chrom_files[chrom], "a") as fp:
+                fp.write("".join(buf))
+
+    # records are buffered by chrom and flushed in batches, so that files are
+    # not reopened per record when chroms are interleaved.
+    chrom_files = OrderedDict()
+    bufs = {}
+    buf_size = 0
+    for line in lines:
+        chrom = line.split("\t", 1)[0]
+        if chrom not in chrom_files:
+            chrom_files[chrom] = os.path.join(tmp_dir, "chrom_%d.vcf" % len(chrom_files))
+        if line[-1:] != "\n":
+            line += "\n"
+        bufs.setdefault(chrom, []).append(line)
+        buf_size += len(line)
+        if buf_size >= SPLIT_BUF_SIZE:
+            __flush(bufs)
+            bufs = {}
+            buf_size = 0
+    __flush(bufs)
+    return(list(chrom_files.items()))
+
+def __fix_file(in_fn, out_fn, ref_fn, nproc = 1, verbose = False):
+    """
+    @abstract       Fix REF, ALT & GT while delete other fields in FORMAT
+    @param in_fn    Input vcf file to be fixed [str]
+    @param out_fn   Output vcf file [str]
+    @param ref_fn   Ref fasta file generated by samtools faidx [str]
+    @param nproc    Number of subprocesses, records are fixed by chrom in
+                    parallel if nproc > 1 [int]
+    @param verbose  If True, output info message of each fixed record [bool]
+    @return         0 if success, -1 otherwise
+    """
+    # fixref and output
+    # TODO: add cmdline of this run to the output file
+    ofp, out_write = __open_out(out_fn)
+
+    # stream the input vcf: header lines are written through as they are met
+    # and records are fixed on the fly.
+    ifp, in_lines = __open_vcf(in_fn)
+    line = None
+    for line in in_lines:
+        if line[0] != "#":
+            break
+        out_write(line)
+    else:
+        line = None
+    rec_lines = itertools.chain([line], in_lines) if line is not None else iter([])
+
+    if nproc <= 1:
+        # the ref cache only holds windows near the current record. Records
+        # are streamed in input order; for a plain vcf file, once a record
+        # out of chrom order is met, the rest records are bucketed by chrom,
+        # with chroms in the order of first appearance.
+        # bgzipped vcf and non-seekable input, e.g., pipe, are streamed as is,
+        # where a warning is given if unsorted.
+        bucket = line is not None and not in_fn.endswith(".gz") and \
+                 os.path.isfile(in_fn) and ifp.seekable()
+        bfp = None
+
+        # load ref fasta, whose bases are fetched by windows on demand
+        FASTA = pysam.FastaFile(ref_fn)
+        ret, nr, fix_cnt, matched_cnt = __fix_lines(rec_lines, FASTA, out_write, 
+                                            verbose, stop_if_unsorted = bucket)
+        if ret == 1:
+            sys.stderr.write("[I::fix_file] records are not grouped by chrom since No.%d, the rest would be bucketed by chrom and numbered in bucketed order.\n" % (nr + 1,))
+            blocks = __index_chrom_blocks(in_fn, nr)
+            bfp = open(in_fn, "rb")
+            ret, nr, _fix_cnt, _matched_cnt = __fix_lines(__iter_chrom_blocks(bfp, blocks), 
+                                            FASTA, out_write, verbose, nr0 = nr)
+            fix_cnt += _fix_cnt
+            matched_cnt += _matched_cnt
+        FASTA.close()
+        ifp.close()
+        if bfp:
+            bfp.close()
+    else:
+        tmp_dir = tempfile.mkdtemp(prefix = "xcltk_fixref_")
+        pool = None
+        try:
+            if in_fn.endswith(".gz") and (os.path.isfile(in_fn + ".tbi") or os.path.isfile(in_fn + ".csi")):
+                ifp.close()
+                tbx = pysam.TabixFile(in_fn)
+                chroms = list(tbx.contigs)
+                tbx.close()
+                tasks = [(in_fn, chrom) for chrom in chroms]
+            else:
+                chrom_files = __split_by_chrom(rec_lines, tmp_dir)
+                ifp.close()
+                tasks = [(fn, None) for chrom, fn in chrom_files]
+
+            pool = multiprocessing.Pool(processes = nproc)
+            result, tmp_files = [], []
+            for i, (fn, chrom) in enumerate(tasks):
+                tmp_fn = os.path.join(tmp_dir, "fixed_%d.vcf" % i)
+                tmp_files.append(tmp_fn)
+                result.append(pool.apply_async(__fix_chrom, (fn, chrom, ref_fn, tmp_fn, verbose)))
+            pool.close()
+            pool.join()
+            result = [res.get() for res in result]
+
+            # merge fixed records in chrom order
+            for tmp_fn in tmp_files:
+                with open(tmp_fn, "r") as fp:
+                    while True:
+                        dat = fp.read(OUT_BUF_SIZE)
+                        if not dat:
+                            break
+                        out_write(dat)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            ifp.close()
+            shutil.rmtree(tmp_dir, ignore_errors = True)
+        ret = min([res[0] for res in result]) if result else 0
+        nr = sum([res[1] for res in result])
+        fix_cnt = sum([res[2] for res in result])
+        matched_cnt = sum([res[3] for res in result])
+
+    if out_fn:
+        ofp.close()
+    if ret < 0:
+        return(-1)
+
     sys.stderr.write("%d valid records in input VCF!\n" % (nr))
     sys.stderr.write("%d records have been fixed REF!\n" % (fix_cnt))
     sys.stderr.write("%d records don't need to fix REF!\n" % (matched_cnt))
+    return(0)
 
-    if out_fn:
-        ofp.close()
+def __fix_bcf(in_fn, out_fn, ref_fn, verbose = False):
+    """
+    @abstract       Fix REF, ALT & GT while delete other fields in FORMAT, through
+                    pysam.VariantFile, used when input or output is BCF
+    @param in_fn    Input vcf/bcf file to be fixed [str]
+    @param out_fn   Output vcf/bcf file [str]
+    @param ref_fn   Ref fasta file generated by samtools faidx [str]
+    @param verbose  If True, output info message of each fixed record [bool]
+    @return         0 if success, -1 otherwise
+    """
+    FASTA = pysam.FastaFile(ref_fn)
+    ref_wins = OrderedDict()    # LRU cache of ref windows, (chrom, win_idx) => seq
+    win_mask = (1 << REF_WIN_SHIFT) - 1
+    valid_chroms = set(FASTA.references)
+    invalid_chroms = set()
+
+    in_vcf = pysam.VariantFile(in_fn)
+    if not out_fn: out_fn, mode = "-", "w"
+    elif out_fn.endswith(".bcf"): mode = "wb"
+    elif out_fn.endswith(".gz"): mode = "wz"
+    else: mode = "w"
+    out_vcf = pysam.VariantFile(out_fn, mode, header = in_vcf.header)
+
+    msgs = [] if verbose else None     # info messages to be written in one batch
+    nr = 0
+    fix_cnt = 0
+    matched_cnt = 0
+    try:
+        for rec in in_vcf:
+            nr += 1
+            chrom, pos, ref = rec.chrom, rec.pos, rec.ref
+            if chrom not in valid_chroms:
+                if chrom not in invalid_chroms:
+                    sys.stderr.write("[W::fix_bcf] skip records of chrom '%s' for it is absent in ref fasta.\n" % chrom)
+                    invalid_chroms.add(chrom)
+                continue
+            seq = __get_ref_win(FASTA, ref_wins, chrom, (pos - 1) >> REF_WIN_SHIFT)
+            i = (pos - 1) & win_mask
+            ref0 = seq[i:i + 1]
+            if ref == ref0:
+                out_vcf.write(rec)
+                matched_cnt += 1
+                continue
+
+            alt = ",".join(rec.alts) if rec.alts else "."
+            smp = rec.samples[0] if len(rec.samples) > 0 else None
+            gt = None
+            if smp is not None and "GT" in smp:
+                gt = smp["GT"]
+            if not gt or len(gt) != 2 or None in gt:
+                sys.stderr.write("[W::fix_bcf] skip No.%d %s:%s for error GT, GT: %s\n" % (nr, chrom, pos, gt))
+                continue
+            sep = "|" if smp.phased else "/"
+            idx1, idx2 = gt
+            try:
+                allele1, allele2 = rec.alleles[idx1], rec.alleles[idx2]
+            except IndexError:
+                sys.stderr.write("[W::fix_bcf] skip No.%d %s:%s for error ALT, ALT str: %s\n" % (nr, chrom, pos, alt))
+                continue
+            if allele1 not in VALID_ALLELES or allele2 not in VALID_ALLELES:
+                sys.stderr.write("[W::fix_bcf] skip No.%d %s:%s for invalid allele, allele1 = %s; allele2 = %s\n" % (nr, chrom, pos, allele1, allele2))
+                continue
+            new_alts, new_idx1, new_idx2 = __fix_alleles(ref0, allele1, allele2)
+
+            # ID, QUAL, INFO & FORMAT fields other than GT are dropped
+            new_rec = out_vcf.new_record(contig = chrom, start = pos - 1, stop = pos,
+                        alleles = [ref0] + new_alts if new_alts else [ref0, "."],
+                        filter = list(rec.filter.keys()))
+            new_rec.samples[0]["GT"] = (new_idx1, new_idx2)
+            new_rec.samples[0].phased = smp.phased
+            for j in range(1, len(rec.samples)):
+                if "GT" in rec.samples[j]:
+                    new_rec.samples[j]["GT"] = rec.samples[j]["GT"]
+                    new_rec.samples[j].phased = rec.samples[j].phased
+            out_vcf.write(new_rec)
+            fix_cnt += 1
+
+            if msgs is not None:
+                new_alt = ",".join(new_alts) if new_alts else "."
+                new_gt = "%d%s%d" % (new_idx1, sep, new_idx2)
+                msgs.append("[I::fix_bcf] change No.%d %s:%s from %s:%s:%d%s%d to %s:%s:%s\n" % (nr, chrom, pos, ref, alt, idx1, sep, idx2, ref0, new_alt, new_gt))
+                if len(msgs) >= LOG_BUF_SIZE:
+                    sys.stderr.write("".join(msgs))
+                    msgs = []
+
+        if msgs: sys.stderr.write("".join(msgs))
+    finally:
+        in_vcf.close()
+        out_vcf.close()
+        FASTA.close()
+
+    sys.stderr.write("%d valid records in input VCF!\n" % (nr))
+    sys.stderr.write("%d records have been fixed REF!\n" % (fix_cnt))
+    sys.stderr.write("%d records don't need to fix REF!\n" % (matched_cnt))
     return(0)
 
 def __usage(fp = sys.stderr):
@@ -191,9 +639,17 @@ def __usage(fp = sys.stderr):
     msg += "Usage: %s %s [options]\n" % (APP, COMMAND)
     msg += "\n"                                                        \
            "Options:\n"                                                \
-           "  -i, --input FILE    Path to input vcf file\n"              \
+           "  -i, --input FILE    Path to input vcf/bcf file\n"          \
            "  -r, --ref FILE      Path to ref fasta file, generated by samtools faidx\n"     \
-           "  -o, --output FILE   Path to output vcf file. if not set, output to stdout\n"    \
+           "  -o, --output FILE   Path to output vcf/bcf file. if not set, output to stdout\n"    \
+           "  -p, --nproc INT     Number of subprocesses, vcf records are fixed by chrom\n"    \
+           "                      in parallel if > 1; ignored for bcf [1]\n"                 \
+           "                      Note that with -p > 1, records are output grouped by\n"     \
+           "                      chrom (in order of first appearance); with -p 1, in\n"      \
+           "                      input order, except that for a plain vcf file, records\n"  \
+           "                      from the first one out of chrom order on are bucketed\n"    \
+           "                      by chrom\n"                                                  \
+           "  -v, --verbose       Print info message of each fixed record\n"                  \
            "  -h, --help          Print this message\n"                                       \
            "\n"
     fp.write(msg)
@@ -204,18 +660,25 @@ def fixref(argv):
         __usage(sys.stderr)
         sys.exit(1)
            
-    opts, args = getopt.getopt(argv[2:], "-h-i:-r:-o:", ["help", "input=", "ref=", "output="])
+    opts, args = getopt.getopt(argv[2:], "-h-i:-r:-o:-p:-v", ["help", "input=", "ref=", "output=", "nproc=", "verbose"])
     ref_file = in_vcf_file = out_vcf_file = None
+    nproc = 1
+    verbose = False
     for op, val in opts:
         if op in ("-i", "--input"): in_vcf_file = val
         elif op in ("-r", "--ref"): ref_file = val
         elif op in ("-o", "--output"): out_vcf_file = val
+        elif op in ("-p", "--nproc"): nproc = int(val)
+        elif op in ("-v", "--verbose"): verbose = True
         elif op in ("-h", "--help"): __usage(sys.stderr); sys.exit(1)
         else: sys.stderr.write("invalid option: %s\n" % op); sys.exit(1)
 
     # TODO: check args
     
-    __fix_file(in_vcf_file, out_vcf_file, ref_file)
+    if in_vcf_file.endswith(".bcf") or (out_vcf_file and out_vcf_file.endswith(".bcf")):
+        __fix_bcf(in_vcf_file, out_vcf_file, ref_file, verbose)
+    else:
+        __fix_file(in_vcf_file, out_vcf_file, ref_file, nproc, verbose)
 
 if __name__ == "__main__":
     fixref(sys.argv)
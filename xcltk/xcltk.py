@@ -6,12 +6,18 @@
 # - add install list (conda + pip)
 
 import sys
+import importlib
 from .config import PROGRAM, VERSION
-from .baf.fixref import fixref as baf_fix_ref
-from .baf.phase_snp import phase_snp as baf_phase_snp
-from .baf.pileup import pileup as baf_pileup
-from .rdr.basefc import base_fc as rdr_base_fc
-from .region.convert import convert as reg_convert
+
+# command => (module, function), modules are imported only when the
+# command is called.
+COMMANDS = {
+    "fixref": (".baf.fixref", "fixref"),
+    "phase_snp": (".baf.phase_snp", "phase_snp"),
+    "pileup": (".baf.pileup", "pileup"),
+    "basefc": (".rdr.basefc", "base_fc"),
+    "convert": (".region.convert", "convert")
+}
 
 def __usage(fp = sys.stderr):
     msg =  "\n"
@@ -45,11 +51,10 @@ def main():
         sys.exit(1)
 
     command = sys.argv[1]
-    if command == "fixref": baf_fix_ref(sys.argv)
-    elif command == "phase_snp": baf_phase_snp(sys.argv)
-    elif command == "pileup": baf_pileup(sys.argv)
-    elif command == "basefc": rdr_base_fc(sys.argv)
-    elif command == "convert": reg_convert(sys.argv)
+    if command in COMMANDS:
+        mod_name, func_name = COMMANDS[command]
+        mod = importlib.import_module(mod_name, __package__)
+        getattr(mod, func_name)(sys.argv)
     elif command in ("-h", "--help"): __usage(); sys.exit(3)
     elif command in ("-V", "--version"): sys.stderr.write("%s\n" % VERSION); sys.exit(3)
     else: sys.stderr.write("Error: wrong command '%s'\n" % command); sys.exit(5)